@@ -0,0 +1,134 @@
+# -----------------------------
+# Numerical checks of the Triton kernels against PyTorch, forward and gradients.
+# Needs a GPU: python check_kernels.py [--dtypes float32 bfloat16]
+# -----------------------------
+
+import argparse
+import torch
+import torch.nn.functional as F
+import triton
+import triton.language as tl
+
+import triton_nanoGPT as tng
+
+device = 'cuda'
+
+# fp32 inputs go through tl.dot as tf32, so even fp32 is not held to 1e-6
+TOLERANCES = {torch.float32: 2e-3, torch.float16: 1e-2, torch.bfloat16: 5e-2}
+
+failures = []
+
+def compare(name, dtype, labels, outs, refs):
+    tol = TOLERANCES[dtype]
+    for label, out, ref in zip(labels, outs, refs):
+        out, ref = out.float(), ref.float()
+        err = (out - ref).abs().max().item()
+        ok = torch.allclose(out, ref, atol=tol, rtol=tol)
+        if not ok:
+            failures.append(f"{name} {label} {dtype}")
+        print(f"{name:<22} {str(dtype):<15} {label:<10} max abs err {err:.2e}  {'ok' if ok else 'FAIL'}")
+
+def check(name, dtype, fn, ref_fn, inputs, labels):
+    # the reference runs in fp32 on the same (already rounded) inputs
+    inputs = [x.detach().requires_grad_(x.is_floating_point()) for x in inputs]
+    ref_inputs = [x.detach().float().requires_grad_() if x.is_floating_point() else x for x in inputs]
+    outs, refs = fn(*inputs), ref_fn(*ref_inputs)
+    outs = outs if isinstance(outs, tuple) else (outs,)
+    refs = refs if isinstance(refs, tuple) else (refs,)
+
+    # likewise both backwards get the same upstream gradients, rounded to the output dtype
+    grad_outs = [torch.randn_like(o) for o in outs]
+    diff = [x for x in inputs if x.requires_grad]
+    ref_diff = [x for x in ref_inputs if x.requires_grad]
+    grads = torch.autograd.grad(outs, diff, grad_outs)
+    ref_grads = torch.autograd.grad(refs, ref_diff, [g.float() for g in grad_outs])
+
+    out_labels = ['out'] if len(outs) == 1 else [f'out{i}' for i in range(len(outs))]
+    compare(name, dtype, out_labels + [f'grad_{l}' for l in labels], list(outs) + list(grads), list(refs) + list(ref_grads))
+
+@triton.jit
+def dropout_keep_kernel(keep_ptr, seed_ptr, dropout_p, seqlen, BLOCK_SIZE: tl.constexpr):
+    # the keep-mask flash_attn_fwd_kernel draws for one (b*h, m) row, same seed and offsets
+    row_idx = tl.program_id(0)
+    cols = tl.arange(0, BLOCK_SIZE)
+    keep = tl.rand(tl.load(seed_ptr), row_idx * seqlen + cols) > dropout_p
+    tl.store(keep_ptr + row_idx * seqlen + cols, keep, mask=cols < seqlen)
+
+def check_attention(dtype, B=2, H=4, T=100, D=32, dropout_p=0.1):
+    scale = D ** -0.5
+    q, k, v = [torch.randn(B, H, T, D, device=device, dtype=dtype) for _ in range(3)]
+    check('flash_attention', dtype,
+          lambda q, k, v: tng.triton_flash_attention(q, k, v, scale),
+          lambda q, k, v: F.scaled_dot_product_attention(q, k, v, is_causal=True, scale=scale),
+          [q, k, v], ['q', 'k', 'v'])
+
+    # the forward draws its seed from the device generator, replay it to rebuild the mask
+    rng_state = torch.cuda.get_rng_state()
+    seed = torch.randint(0, 2 ** 31 - 1, (1,), device=device)
+    keep = torch.empty(B, H, T, T, device=device, dtype=torch.bool)
+    dropout_keep_kernel[(B * H * T,)](keep, seed, dropout_p, T, BLOCK_SIZE=triton.next_power_of_2(T))
+    causal = torch.ones(T, T, device=device, dtype=torch.bool).tril()
+
+    def flash_dropout(q, k, v):
+        torch.cuda.set_rng_state(rng_state)
+        return tng.triton_flash_attention(q, k, v, scale, dropout_p)
+
+    def reference_dropout(q, k, v):
+        attn = ((q @ k.transpose(-2, -1)) * scale).masked_fill(~causal, float('-inf')).softmax(dim=-1)
+        return (attn * keep / (1.0 - dropout_p)) @ v
+
+    check('flash_attention_drop', dtype, flash_dropout, reference_dropout, [q, k, v], ['q', 'k', 'v'])
+
+def check_layer_norm(dtype, B=4, T=37, C=96, eps=1e-5):
+    x, residual = [torch.randn(B, T, C, device=device, dtype=dtype) for _ in range(2)]
+    weight = torch.randn(C, device=device)
+    bias = torch.randn(C, device=device)
+    check('fused_add_layer_norm', dtype,
+          lambda x, r, w, b: tng.triton_fused_add_layer_norm(x, r, w, b, eps),
+          lambda x, r, w, b: (x + r, F.layer_norm(x + r, (C,), w, b, eps)),
+          [x, residual, weight, bias], ['x', 'residual', 'weight', 'bias'])
+    check('layer_norm', dtype,
+          lambda x, w, b: tng.triton_fused_add_layer_norm(x, None, w, b, eps)[1],
+          lambda x, w, b: F.layer_norm(x, (C,), w, b, eps),
+          [x, weight, bias], ['x', 'weight', 'bias'])
+
+def check_bias_gelu(dtype, M=300, N=384):
+    x = torch.randn(M, N, device=device, dtype=dtype)
+    bias = torch.randn(N, device=device)
+    check('bias_gelu', dtype,
+          tng.triton_bias_gelu,
+          lambda x, b: F.gelu(x + b),
+          [x, bias], ['x', 'bias'])
+
+def check_cross_entropy(dtype, N=500, V=65):
+    logits = torch.randn(N, V, device=device, dtype=dtype) * 3
+    targets = torch.randint(0, V, (N,), device=device)
+    check('cross_entropy', dtype,
+          tng.triton_cross_entropy_loss,
+          F.cross_entropy,
+          [logits, targets], ['logits'])
+
+def check_qkv_proj(dtype, B=2, T=37, C=96, H=4):
+    x = torch.randn(B, T, C, device=device, dtype=dtype)
+    weight = torch.randn(3 * C, C, device=device, dtype=dtype) * C ** -0.5
+    check('fused_qkv_proj', dtype,
+          lambda x, w: tng.triton_fused_qkv_proj(x, w, H),
+          lambda x, w: F.linear(x, w).view(B, T, 3, H, C // H).permute(2, 0, 3, 1, 4),
+          [x, weight], ['x', 'weight'])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dtypes', nargs='+', default=['float32', 'bfloat16'], choices=['float32', 'float16', 'bfloat16'])
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    for dtype in [getattr(torch, name) for name in args.dtypes]:
+        check_attention(dtype)
+        check_layer_norm(dtype)
+        check_bias_gelu(dtype)
+        check_cross_entropy(dtype)
+        check_qkv_proj(dtype)
+
+    if failures:
+        raise SystemExit(f"{len(failures)} check(s) failed: {', '.join(failures)}")
+    print("all checks passed")
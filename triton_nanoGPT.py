@@ -32,152 +32,466 @@ def dataset(url, filepath):
 url = "https://raw.githubusercontent.com/karpathy/char-rnn/master/data/tinyshakespeare/input.txt"
 filepath = "input.txt"
 
-dataset(url, filepath)
-with open('input.txt', 'r') as f:
-    text = f.read()
-
-chars = sorted(list(set(text)))
-vocab_size = len(chars)
-print(f"Vocabulary size: {vocab_size}")
-
-stoi = { ch:i for i,ch in enumerate(chars) }
-itos = { i:ch for i,ch in enumerate(chars) }
+# encode/decode use the stoi/itos lookup tables built from the dataset under __main__ below,
+# so importing this module (e.g. from check_kernels.py) neither downloads nor loads any data
 
 def encode(text):
-    return torch.tensor([stoi[c] for c in text], dtype=torch.long)
+    # frombuffer rejects an empty buffer
+    if not text:
+        return torch.empty(0, dtype=torch.long)
+    ids = stoi[torch.frombuffer(bytearray(text, 'latin-1'), dtype=torch.uint8).long()]
+    assert (ids >= 0).all(), "text contains characters that are not in the vocabulary"
+    return ids
 
 def decode(indices):
-    return ''.join([itos[i.item()] for i in indices])
-
-data = encode(text)
-
-n = int(0.9 * len(data))
-train_data = data[:n].cuda()
-test_data = data[n:].cuda()
-
-print(f"Training data size: {train_data.numel()} characters")
-print(f"Testing data size: {test_data.numel()} characters")
+    # one device->host copy for the whole sequence rather than an .item() sync per token
+    return bytes(itos[indices.cpu()].tolist()).decode('latin-1')
 
 # -----------------------------
 # Triton Kernels
 # -----------------------------
 
+# shared search space, the autotuner caches the winner per key so tuning is paid once per shape
+autotune_configs = [
+    triton.Config({'BLOCK_SIZE': bs}, num_warps=w, num_stages=s)
+    for bs in (64, 128, 256, 512, 1024) for w in (2, 4, 8) for s in (2, 3, 4)
+]
+
+# row kernels reduce over a whole row in one tile, so BLOCK_SIZE is the row width rounded up
+# to a power of two and passed at launch; only warps/stages are tuned. Every config is valid
+# for every shape, which keeps the autotuners to configs + key as torch.compile requires
+row_configs = [
+    triton.Config({}, num_warps=w, num_stages=s)
+    for w in (2, 4, 8) for s in (2, 3, 4)
+]
+
+# LayerNorm also tiles over rows, so small M (e.g. generation) still fills the SMs;
+# a fixed number of persistent programs then stride over the row tiles
+layer_norm_configs = [
+    triton.Config({'ROWS_PER_TILE': r}, num_warps=w, num_stages=s)
+    for r in (1, 2, 4, 8) for w in (2, 4, 8) for s in (2, 3, 4)
+]
+
+@triton.autotune(configs=layer_norm_configs, key=['M', 'N'])
+@triton.jit
+def fused_add_layer_norm_kernel(
+    x_ptr, res_ptr, weight_ptr, bias_ptr, y_ptr, x_out_ptr,
+    M, N, eps: tl.constexpr,
+    HAS_RESIDUAL: tl.constexpr,
+    BLOCK_SIZE: tl.constexpr, ROWS_PER_TILE: tl.constexpr
+):
+    cols = tl.arange(0, BLOCK_SIZE)
+    col_mask = cols < N
+    w = tl.load(weight_ptr + cols, mask=col_mask, other=1.0)
+    b = tl.load(bias_ptr + cols, mask=col_mask, other=0.0)
+
+    for tile in range(tl.program_id(0), tl.cdiv(M, ROWS_PER_TILE), tl.num_programs(0)):
+        rows = tile * ROWS_PER_TILE + tl.arange(0, ROWS_PER_TILE)
+        mask = (rows[:, None] < M) & col_mask[None, :]
+        offsets = rows[:, None] * N + cols[None, :]
+
+        # statistics are accumulated in fp32 whatever the storage dtype
+        x = tl.load(x_ptr + offsets, mask=mask, other=0.0).to(tl.float32)
+        if HAS_RESIDUAL:
+            # the residual sum is written once for the next block and normalized from registers
+            x += tl.load(res_ptr + offsets, mask=mask, other=0.0).to(tl.float32)
+            tl.store(x_out_ptr + offsets, x, mask=mask)
+
+        mean = tl.sum(x, axis=1) / N
+        x_centered = tl.where(mask, x - mean[:, None], 0.0)
+        var = tl.sum(x_centered * x_centered, axis=1) / N
+        rstd = 1.0 / tl.sqrt(var + eps)
+
+        y = (x_centered * rstd[:, None]) * w[None, :] + b[None, :]
+        tl.store(y_ptr + offsets, y, mask=mask)
+
+@triton.autotune(configs=row_configs, key=['n_classes'])
 @triton.jit
-def softmax_kernel(
-    output_ptr, input_ptr, input_row_stride, output_row_stride, n_cols,
+def cross_entropy_loss_kernel(
+    logits_ptr, targets_ptr, loss_ptr, lse_ptr,
+    logits_row_stride, n_classes,
     BLOCK_SIZE: tl.constexpr
 ):
     row_idx = tl.program_id(0)
-    col_offsets = tl.arange(0, BLOCK_SIZE)
-    mask = col_offsets < n_cols
+    cols = tl.arange(0, BLOCK_SIZE)
+    mask = cols < n_classes
 
-    input_row_ptr = input_ptr + row_idx * input_row_stride + col_offsets
-    output_row_ptr = output_ptr + row_idx * output_row_stride + col_offsets
+    # one coalesced read of the row in its storage dtype, the logsumexp is accumulated in fp32
+    logits = tl.load(logits_ptr + row_idx * logits_row_stride + cols, mask=mask, other=float('-inf')).to(tl.float32)
+    target = tl.load(targets_ptr + row_idx)
 
-    logits = tl.load(input_row_ptr, mask=mask, other=float('-inf'))
-    max_logits = tl.max(logits, axis=0)
-    logits = logits - max_logits
-    exp_logits = tl.exp(logits)
-    sum_exp_logits = tl.sum(exp_logits, axis=0) + 1e-6
+    row_max = tl.max(logits, axis=0)
+    lse = row_max + tl.log(tl.sum(tl.exp(logits - row_max), axis=0))
+    target_logit = tl.sum(tl.where(cols == target, logits, 0.0), axis=0)
 
-    softmax_output = exp_logits / sum_exp_logits
-    tl.store(output_row_ptr, softmax_output, mask=mask)
+    tl.store(loss_ptr + row_idx, lse - target_logit)
+    tl.store(lse_ptr + row_idx, lse)
 
+@triton.autotune(configs=row_configs, key=['n_cols'])
 @triton.jit
-def layer_norm_kernel(
-    x_ptr, weight_ptr, bias_ptr, y_ptr,
-    N, eps: tl.constexpr,
+def gumbel_argmax_kernel(
+    logits_ptr, out_ptr, seed, logits_row_stride, n_cols,
     BLOCK_SIZE: tl.constexpr
 ):
     row_idx = tl.program_id(0)
     cols = tl.arange(0, BLOCK_SIZE)
-    mask = cols < N
-
-    x_offset = x_ptr + row_idx * N + cols
-    x = tl.load(x_offset, mask=mask, other=0.0)
-
-    mean = tl.sum(x, axis=0) / N
-    x_centered = x - mean
-    var = tl.sum(x_centered * x_centered, axis=0) / N
-    rstd = 1.0 / tl.sqrt(var + eps)
+    mask = cols < n_cols
 
-    w = tl.load(weight_ptr + cols, mask=mask, other=1.0)
-    b = tl.load(bias_ptr + cols, mask=mask, other=0.0)
-
-    y = (x_centered * rstd) * w + b
-    tl.store(y_ptr + row_idx * N + cols, y, mask=mask)
+    logits = tl.load(logits_ptr + row_idx * logits_row_stride + cols, mask=mask, other=float('-inf')).to(tl.float32)
+    # Gumbel-max: argmax(logits + Gumbel noise) is a sample from softmax(logits), no probabilities needed
+    u = tl.rand(seed, row_idx * n_cols + cols)
+    gumbel = -tl.log(-tl.log(tl.maximum(u, 1e-20)))
+    tl.store(out_ptr + row_idx, tl.argmax(logits + gumbel, axis=0))
 
+@triton.autotune(configs=autotune_configs, key=['n_elements'])
 @triton.jit
-def cross_entropy_loss_kernel(
-    logits_ptr, targets_ptr, loss_ptr, 
-    n_classes, n_elements,
+def bias_gelu_kernel(
+    x_ptr, bias_ptr, y_ptr, n_elements, H,
     BLOCK_SIZE: tl.constexpr
 ):
-    pid = tl.program_id(0)
-    block_start = pid * BLOCK_SIZE
-    offsets = block_start + tl.arange(0, BLOCK_SIZE)
+    offsets = tl.program_id(0) * BLOCK_SIZE + tl.arange(0, BLOCK_SIZE)
     mask = offsets < n_elements
 
-    targets = tl.load(targets_ptr + offsets, mask=mask, other=-1)
+    # the bias add rides along with the GELU while x is already in registers
+    x = tl.load(x_ptr + offsets, mask=mask).to(tl.float32)
+    b = tl.load(bias_ptr + offsets % H, mask=mask).to(tl.float32)
+    x = x + b
 
-    row_max = tl.full([BLOCK_SIZE], float('-inf'), dtype=tl.float32)
-    row_sum = tl.zeros([BLOCK_SIZE], dtype=tl.float32)
+    # exact GELU, erf is a single instruction and the kernel is memory-bound anyway
+    y = 0.5 * x * (1.0 + tl.erf(x * 0.7071067811865475))
 
-    for i in range(n_classes):
-        col_offset = offsets * n_classes + i
-        logit = tl.load(logits_ptr + col_offset, mask=mask, other=float('-inf'))
-        row_max = tl.maximum(row_max, logit)
-
-    loss = tl.zeros([BLOCK_SIZE], dtype=tl.float32)
-    for i in range(n_classes):
-        col_offset = offsets * n_classes + i
-        logit = tl.load(logits_ptr + col_offset, mask=mask, other=float('-inf'))
-        exp_logit = tl.exp(logit - row_max)
-        row_sum += exp_logit
-        loss = tl.where(targets == i, loss - logit + row_max, loss)
-
-    loss += tl.log(row_sum)
-
-    tl.store(loss_ptr + offsets, loss, mask=mask)
+    tl.store(y_ptr + offsets, y, mask=mask)
 
+@triton.autotune(
+    configs=[
+        triton.Config({'BLOCK_M': bm, 'BLOCK_N': bn}, num_warps=w, num_stages=s)
+        for bm in (32, 64, 128) for bn in (32, 64) for w in (4, 8) for s in (2, 3)
+    ],
+    key=['seqlen', 'head_dim']
+)
 @triton.jit
-def gelu_kernel(
-    x_ptr, y_ptr, n_elements,
-    BLOCK_SIZE: tl.constexpr
+def flash_attn_fwd_kernel(
+    q_ptr, k_ptr, v_ptr, out_ptr, lse_ptr, sm_scale, dropout_p, seed_ptr,
+    stride_qb, stride_qh, stride_qm, stride_qk,
+    stride_kb, stride_kh, stride_kn, stride_kk,
+    stride_vb, stride_vh, stride_vn, stride_vk,
+    stride_ob, stride_oh, stride_om, stride_ok,
+    n_heads, seqlen, head_dim,
+    BLOCK_M: tl.constexpr, BLOCK_N: tl.constexpr, BLOCK_DMODEL: tl.constexpr,
+    IS_CAUSAL: tl.constexpr, DROPOUT: tl.constexpr
 ):
-    offsets = tl.program_id(0) * BLOCK_SIZE + tl.arange(0, BLOCK_SIZE)
-    mask = offsets < n_elements
-
-    x = tl.load(x_ptr + offsets, mask=mask)
+    start_m = tl.program_id(0)
+    off_hz = tl.program_id(1)
+    off_b = off_hz // n_heads
+    off_h = off_hz % n_heads
+
+    offs_m = start_m * BLOCK_M + tl.arange(0, BLOCK_M)
+    offs_n = tl.arange(0, BLOCK_N)
+    offs_d = tl.arange(0, BLOCK_DMODEL)
+    d_mask = offs_d < head_dim
+
+    q_ptrs = q_ptr + off_b * stride_qb + off_h * stride_qh + offs_m[:, None] * stride_qm + offs_d[None, :] * stride_qk
+    # K is read as (BLOCK_DMODEL, BLOCK_N) straight through its strides, no transpose needed for tl.dot
+    k_ptrs = k_ptr + off_b * stride_kb + off_h * stride_kh + offs_n[None, :] * stride_kn + offs_d[:, None] * stride_kk
+    v_ptrs = v_ptr + off_b * stride_vb + off_h * stride_vh + offs_n[:, None] * stride_vn + offs_d[None, :] * stride_vk
+
+    # the Q tile stays in SRAM while K/V tiles stream past it
+    q = tl.load(q_ptrs, mask=(offs_m[:, None] < seqlen) & d_mask[None, :], other=0.0)
+
+    m_i = tl.full([BLOCK_M], float('-inf'), dtype=tl.float32)
+    l_i = tl.zeros([BLOCK_M], dtype=tl.float32)
+    acc = tl.zeros([BLOCK_M, BLOCK_DMODEL], dtype=tl.float32)
+
+    # causal: key tiles entirely above the diagonal never contribute, so stop at it
+    if IS_CAUSAL:
+        hi = tl.minimum((start_m + 1) * BLOCK_M, seqlen)
+    else:
+        hi = seqlen
+
+    for start_n in range(0, hi, BLOCK_N):
+        cols = start_n + offs_n
+        k = tl.load(k_ptrs + start_n * stride_kn, mask=(cols[None, :] < seqlen) & d_mask[:, None], other=0.0)
+        v = tl.load(v_ptrs + start_n * stride_vn, mask=(cols[:, None] < seqlen) & d_mask[None, :], other=0.0)
+
+        qk = tl.dot(q, k) * sm_scale
+        valid = cols[None, :] < seqlen
+        if IS_CAUSAL:
+            valid = valid & (offs_m[:, None] >= cols[None, :])
+        # -1e20 rather than -inf keeps fully masked rows from producing NaNs
+        qk = tl.where(valid, qk, -1e20)
+
+        # online softmax: rescale the running sum/accumulator to the new row max
+        m_new = tl.maximum(m_i, tl.max(qk, axis=1))
+        alpha = tl.exp(m_i - m_new)
+        p = tl.exp(qk - m_new[:, None])
+        l_i = l_i * alpha + tl.sum(p, axis=1)
+        acc = acc * alpha[:, None]
+        if DROPOUT:
+            # Philox keyed on the flat (b*h, m, n) index, the backward kernels regenerate the same mask
+            rng_offsets = (off_hz * seqlen + offs_m[:, None]) * seqlen + cols[None, :]
+            keep = tl.rand(tl.load(seed_ptr), rng_offsets) > dropout_p
+            p = tl.where(keep, p / (1.0 - dropout_p), 0.0)
+        # P is cast down to the input dtype so both matmuls run on tensor cores, accumulation stays fp32
+        acc += tl.dot(p.to(v.dtype), v)
+        m_i = m_new
+
+    acc = acc / l_i[:, None]
+    # the row logsumexp is all the backward needs to rebuild P tile by tile
+    tl.store(lse_ptr + off_hz * seqlen + offs_m, m_i + tl.log(l_i), mask=offs_m < seqlen)
+    out_ptrs = out_ptr + off_b * stride_ob + off_h * stride_oh + offs_m[:, None] * stride_om + offs_d[None, :] * stride_ok
+    tl.store(out_ptrs, acc.to(out_ptr.dtype.element_ty), mask=(offs_m[:, None] < seqlen) & d_mask[None, :])
+
+@triton.autotune(
+    configs=[
+        triton.Config({'BLOCK_M': bm, 'BLOCK_N': bn, 'BLOCK_K': bk}, num_warps=w, num_stages=s)
+        for bm in (64, 128) for bn in (64, 128) for bk in (32, 64) for w in (4, 8) for s in (3, 4)
+    ],
+    key=['M', 'N', 'K']
+)
+@triton.jit
+def fused_qkv_proj_kernel(
+    x_ptr, w_ptr, out_ptr,
+    M, N, K, seqlen, n_heads, head_dim,
+    stride_xm, stride_xk,
+    stride_wn, stride_wk,
+    stride_o3, stride_ob, stride_oh, stride_ot, stride_od,
+    BLOCK_M: tl.constexpr, BLOCK_N: tl.constexpr, BLOCK_K: tl.constexpr
+):
+    pid_m = tl.program_id(0)
+    pid_n = tl.program_id(1)
+
+    offs_m = pid_m * BLOCK_M + tl.arange(0, BLOCK_M)
+    offs_n = pid_n * BLOCK_N + tl.arange(0, BLOCK_N)
+    offs_k = tl.arange(0, BLOCK_K)
+
+    x_ptrs = x_ptr + offs_m[:, None] * stride_xm + offs_k[None, :] * stride_xk
+    # the weight is (N, K) like nn.Linear's, read as (BLOCK_K, BLOCK_N) tiles of its transpose
+    w_ptrs = w_ptr + offs_n[None, :] * stride_wn + offs_k[:, None] * stride_wk
+
+    acc = tl.zeros([BLOCK_M, BLOCK_N], dtype=tl.float32)
+    for k in range(0, K, BLOCK_K):
+        x = tl.load(x_ptrs, mask=(offs_m[:, None] < M) & (offs_k[None, :] + k < K), other=0.0)
+        w = tl.load(w_ptrs, mask=(offs_n[None, :] < N) & (offs_k[:, None] + k < K), other=0.0)
+        acc += tl.dot(x, w)
+        x_ptrs += BLOCK_K * stride_xk
+        w_ptrs += BLOCK_K * stride_wk
+
+    # rows are (b, t) and columns (q/k/v, h, d), stored straight into the (3, B, H, T, D) layout
+    off_b = offs_m // seqlen
+    off_t = offs_m % seqlen
+    off_3 = offs_n // (n_heads * head_dim)
+    off_h = (offs_n // head_dim) % n_heads
+    off_d = offs_n % head_dim
+    out_ptrs = (out_ptr
+                + (off_b * stride_ob + off_t * stride_ot)[:, None]
+                + (off_3 * stride_o3 + off_h * stride_oh + off_d * stride_od)[None, :])
+    tl.store(out_ptrs, acc.to(out_ptr.dtype.element_ty), mask=(offs_m[:, None] < M) & (offs_n[None, :] < N))
+
+flash_attn_bwd_configs = [
+    triton.Config({'BLOCK_M': bm, 'BLOCK_N': bn}, num_warps=w, num_stages=s)
+    for bm in (32, 64) for bn in (32, 64) for w in (4, 8) for s in (2, 3)
+]
 
-    sqrt_2_over_pi = 0.7978845608028654
-    coeff = sqrt_2_over_pi * (1 + 0.044715 * x * x)
-    y = 0.5 * x * (1 + (x * coeff) / (1 + tl.abs(x * coeff)))
+@triton.jit
+def flash_attn_bwd_probs(
+    q, k, v, do, lse, delta, offs_m, offs_n, off_hz, sm_scale, dropout_p, seed_ptr, seqlen,
+    IS_CAUSAL: tl.constexpr, DROPOUT: tl.constexpr
+):
+    # rebuilds one (BLOCK_M, BLOCK_N) tile of P from the forward's logsumexp and returns
+    # the dropped-out P that multiplied V together with dS = P * (dP - delta) * scale
+    qk = tl.dot(q, tl.trans(k)) * sm_scale
+    valid = (offs_m[:, None] < seqlen) & (offs_n[None, :] < seqlen)
+    if IS_CAUSAL:
+        valid = valid & (offs_m[:, None] >= offs_n[None, :])
+    p = tl.where(valid, tl.exp(qk - lse[:, None]), 0.0)
+    dp = tl.dot(do, tl.trans(v))
+    if DROPOUT:
+        # same Philox offsets as the forward, the mask only ever exists in registers
+        keep = tl.rand(tl.load(seed_ptr), (off_hz * seqlen + offs_m[:, None]) * seqlen + offs_n[None, :]) > dropout_p
+        p_dropped = tl.where(keep, p / (1.0 - dropout_p), 0.0)
+        dp = tl.where(keep, dp / (1.0 - dropout_p), 0.0)
+    else:
+        p_dropped = p
+    ds = p * (dp - delta[:, None]) * sm_scale
+    return p_dropped, ds
 
-    tl.store(y_ptr + offsets, y, mask=mask)
+@triton.autotune(configs=flash_attn_bwd_configs, key=['seqlen', 'head_dim'])
+@triton.jit
+def flash_attn_bwd_dkdv_kernel(
+    q_ptr, k_ptr, v_ptr, do_ptr, lse_ptr, delta_ptr, dk_ptr, dv_ptr,
+    sm_scale, dropout_p, seed_ptr,
+    stride_b, stride_h, stride_m, stride_k,
+    n_heads, seqlen, head_dim,
+    BLOCK_M: tl.constexpr, BLOCK_N: tl.constexpr, BLOCK_DMODEL: tl.constexpr,
+    IS_CAUSAL: tl.constexpr, DROPOUT: tl.constexpr
+):
+    # one program per key tile, dK and dV accumulate in SRAM while query tiles stream past
+    start_n = tl.program_id(0)
+    off_hz = tl.program_id(1)
+    # q, k, v, dO and the gradients share one contiguous (B, H, T, D) layout
+    base = (off_hz // n_heads) * stride_b + (off_hz % n_heads) * stride_h
+
+    offs_n = start_n * BLOCK_N + tl.arange(0, BLOCK_N)
+    offs_d = tl.arange(0, BLOCK_DMODEL)
+    d_mask = offs_d < head_dim
+    kv_offsets = base + offs_n[:, None] * stride_m + offs_d[None, :] * stride_k
+    kv_mask = (offs_n[:, None] < seqlen) & d_mask[None, :]
+    k = tl.load(k_ptr + kv_offsets, mask=kv_mask, other=0.0)
+    v = tl.load(v_ptr + kv_offsets, mask=kv_mask, other=0.0)
+
+    dk = tl.zeros([BLOCK_N, BLOCK_DMODEL], dtype=tl.float32)
+    dv = tl.zeros([BLOCK_N, BLOCK_DMODEL], dtype=tl.float32)
+
+    # causal: query tiles entirely above the diagonal never saw these keys
+    lo = (start_n * BLOCK_N // BLOCK_M) * BLOCK_M if IS_CAUSAL else 0
+    for start_m in range(lo, seqlen, BLOCK_M):
+        offs_m = start_m + tl.arange(0, BLOCK_M)
+        m_mask = offs_m < seqlen
+        q_offsets = base + offs_m[:, None] * stride_m + offs_d[None, :] * stride_k
+        q_mask = m_mask[:, None] & d_mask[None, :]
+        q = tl.load(q_ptr + q_offsets, mask=q_mask, other=0.0)
+        do = tl.load(do_ptr + q_offsets, mask=q_mask, other=0.0)
+        lse = tl.load(lse_ptr + off_hz * seqlen + offs_m, mask=m_mask, other=0.0)
+        delta = tl.load(delta_ptr + off_hz * seqlen + offs_m, mask=m_mask, other=0.0)
+
+        p, ds = flash_attn_bwd_probs(q, k, v, do, lse, delta, offs_m, offs_n, off_hz, sm_scale,
+                                     dropout_p, seed_ptr, seqlen, IS_CAUSAL, DROPOUT)
+        dv += tl.dot(tl.trans(p.to(do.dtype)), do)
+        dk += tl.dot(tl.trans(ds.to(q.dtype)), q)
+
+    tl.store(dk_ptr + kv_offsets, dk.to(dk_ptr.dtype.element_ty), mask=kv_mask)
+    tl.store(dv_ptr + kv_offsets, dv.to(dv_ptr.dtype.element_ty), mask=kv_mask)
+
+@triton.autotune(configs=flash_attn_bwd_configs, key=['seqlen', 'head_dim'])
+@triton.jit
+def flash_attn_bwd_dq_kernel(
+    q_ptr, k_ptr, v_ptr, do_ptr, lse_ptr, delta_ptr, dq_ptr,
+    sm_scale, dropout_p, seed_ptr,
+    stride_b, stride_h, stride_m, stride_k,
+    n_heads, seqlen, head_dim,
+    BLOCK_M: tl.constexpr, BLOCK_N: tl.constexpr, BLOCK_DMODEL: tl.constexpr,
+    IS_CAUSAL: tl.constexpr, DROPOUT: tl.constexpr
+):
+    # dQ gets its own pass over the key tiles rather than atomics, so the result is deterministic
+    start_m = tl.program_id(0)
+    off_hz = tl.program_id(1)
+    base = (off_hz // n_heads) * stride_b + (off_hz % n_heads) * stride_h
+
+    offs_m = start_m * BLOCK_M + tl.arange(0, BLOCK_M)
+    offs_d = tl.arange(0, BLOCK_DMODEL)
+    d_mask = offs_d < head_dim
+    m_mask = offs_m < seqlen
+    q_offsets = base + offs_m[:, None] * stride_m + offs_d[None, :] * stride_k
+    q_mask = m_mask[:, None] & d_mask[None, :]
+    q = tl.load(q_ptr + q_offsets, mask=q_mask, other=0.0)
+    do = tl.load(do_ptr + q_offsets, mask=q_mask, other=0.0)
+    lse = tl.load(lse_ptr + off_hz * seqlen + offs_m, mask=m_mask, other=0.0)
+    delta = tl.load(delta_ptr + off_hz * seqlen + offs_m, mask=m_mask, other=0.0)
+
+    dq = tl.zeros([BLOCK_M, BLOCK_DMODEL], dtype=tl.float32)
+
+    if IS_CAUSAL:
+        hi = tl.minimum((start_m + 1) * BLOCK_M, seqlen)
+    else:
+        hi = seqlen
+    for start_n in range(0, hi, BLOCK_N):
+        offs_n = start_n + tl.arange(0, BLOCK_N)
+        kv_offsets = base + offs_n[:, None] * stride_m + offs_d[None, :] * stride_k
+        kv_mask = (offs_n[:, None] < seqlen) & d_mask[None, :]
+        k = tl.load(k_ptr + kv_offsets, mask=kv_mask, other=0.0)
+        v = tl.load(v_ptr + kv_offsets, mask=kv_mask, other=0.0)
+
+        _, ds = flash_attn_bwd_probs(q, k, v, do, lse, delta, offs_m, offs_n, off_hz, sm_scale,
+                                     dropout_p, seed_ptr, seqlen, IS_CAUSAL, DROPOUT)
+        dq += tl.dot(ds.to(k.dtype), k)
+
+    tl.store(dq_ptr + q_offsets, dq.to(dq_ptr.dtype.element_ty), mask=q_mask)
+
+# keyed on head_dim only: seqlen grows by one every decode step and would re-tune each token
+@triton.autotune(
+    configs=[
+        triton.Config({'BLOCK_N': bn}, num_warps=w, num_stages=s)
+        for bn in (16, 32, 64, 128) for w in (1, 2, 4) for s in (2, 3)
+    ],
+    key=['head_dim']
+)
+@triton.jit
+def flash_attn_decode_kernel(
+    q_ptr, k_ptr, v_ptr, k_scale_ptr, v_scale_ptr, out_ptr, sm_scale,
+    stride_qb, stride_qh, stride_qk,
+    stride_kb, stride_kh, stride_kn, stride_kk,
+    stride_vb, stride_vh, stride_vn, stride_vk,
+    stride_sb, stride_sh,
+    stride_ob, stride_oh, stride_ok,
+    n_heads, seqlen, head_dim,
+    BLOCK_N: tl.constexpr, BLOCK_DMODEL: tl.constexpr,
+    KV_INT8: tl.constexpr
+):
+    # one program per (batch, head), a single query row attends over the whole cache
+    off_hz = tl.program_id(0)
+    off_b = off_hz // n_heads
+    off_h = off_hz % n_heads
+
+    offs_n = tl.arange(0, BLOCK_N)
+    offs_d = tl.arange(0, BLOCK_DMODEL)
+    d_mask = offs_d < head_dim
+
+    q = tl.load(q_ptr + off_b * stride_qb + off_h * stride_qh + offs_d * stride_qk, mask=d_mask, other=0.0).to(tl.float32)
+    k_ptrs = k_ptr + off_b * stride_kb + off_h * stride_kh + offs_n[:, None] * stride_kn + offs_d[None, :] * stride_kk
+    v_ptrs = v_ptr + off_b * stride_vb + off_h * stride_vh + offs_n[:, None] * stride_vn + offs_d[None, :] * stride_vk
+    k_scale_ptrs = k_scale_ptr + off_b * stride_sb + off_h * stride_sh + offs_n
+    v_scale_ptrs = v_scale_ptr + off_b * stride_sb + off_h * stride_sh + offs_n
+
+    # with one query row tl.dot does not apply, so each of the BLOCK_N lanes keeps its own
+    # online-softmax state and the lanes are merged once at the end
+    m_i = tl.full([BLOCK_N], float('-inf'), dtype=tl.float32)
+    l_i = tl.zeros([BLOCK_N], dtype=tl.float32)
+    acc = tl.zeros([BLOCK_N, BLOCK_DMODEL], dtype=tl.float32)
+
+    for start_n in range(0, seqlen, BLOCK_N):
+        n_mask = (start_n + offs_n) < seqlen
+        kv_mask = n_mask[:, None] & d_mask[None, :]
+        k = tl.load(k_ptrs + start_n * stride_kn, mask=kv_mask, other=0).to(tl.float32)
+        v = tl.load(v_ptrs + start_n * stride_vn, mask=kv_mask, other=0).to(tl.float32)
+        if KV_INT8:
+            # dequantize in registers, only the int8 cache and its scales cross HBM
+            k = k * tl.load(k_scale_ptrs + start_n, mask=n_mask, other=0.0).to(tl.float32)[:, None]
+            v = v * tl.load(v_scale_ptrs + start_n, mask=n_mask, other=0.0).to(tl.float32)[:, None]
+
+        qk = tl.sum(q[None, :] * k, axis=1) * sm_scale
+        qk = tl.where(n_mask, qk, -1e20)
+
+        m_new = tl.maximum(m_i, qk)
+        alpha = tl.exp(m_i - m_new)
+        p = tl.where(n_mask, tl.exp(qk - m_new), 0.0)
+        l_i = l_i * alpha + p
+        acc = acc * alpha[:, None] + p[:, None] * v
+        m_i = m_new
+
+    m = tl.max(m_i, axis=0)
+    alpha = tl.exp(m_i - m)
+    l = tl.sum(l_i * alpha, axis=0)
+    out = tl.sum(acc * alpha[:, None], axis=0) / l
+
+    out_ptrs = out_ptr + off_b * stride_ob + off_h * stride_oh + offs_d * stride_ok
+    tl.store(out_ptrs, out.to(out_ptr.dtype.element_ty), mask=d_mask)
 
 # -----------------------------------
 # Triton-accelerated Launch Functions
 # -----------------------------------
 
-class TritonSoftmax(nn.Module):
-    def forward(self, x):
-        original_shape = x.shape
-        if len(original_shape) > 2:
-            x = x.view(-1, original_shape[-1])
-        x = x.clamp(-100, 100)
-        B, N = x.shape
-        y = torch.empty_like(x)
-        grid = lambda meta: (B,)
-        softmax_kernel[grid](
-            y, x,
-            x.stride(0), y.stride(0), N,
-            BLOCK_SIZE=triton.next_power_of_2(N)
-        )
-        y = y + 1e-8
-        y = y / y.sum(dim=-1, keepdim=True)
-        return y.view(original_shape)
-    
+def triton_sample(logits):
+    B, V = logits.shape
+    next_token = torch.empty(B, 1, device=logits.device, dtype=torch.long)
+    # seeded from torch's CPU generator, so no device sync per token
+    seed = torch.randint(0, 2 ** 31 - 1, (1,)).item()
+    grid = lambda meta: (B,)
+    gumbel_argmax_kernel[grid](
+        logits, next_token, seed, logits.stride(0), V,
+        BLOCK_SIZE=triton.next_power_of_2(V)
+    )
+    return next_token
+
 def triton_cross_entropy_loss(logits, targets):
     return TritonCrossEntropyLoss.apply(logits, targets)
 
@@ -185,33 +499,36 @@ class TritonCrossEntropyLoss(torch.autograd.Function):
     @staticmethod
     def forward(ctx, logits, targets):
         n_elements, n_classes = logits.shape
-        loss = torch.empty(n_elements, device=logits.device, dtype=logits.dtype)
-        
-        grid = lambda meta: (triton.cdiv(n_elements, meta['BLOCK_SIZE']),)
-        
+        loss = torch.empty(n_elements, device=logits.device, dtype=torch.float32)
+        lse = torch.empty(n_elements, device=logits.device, dtype=torch.float32)
+
+        grid = lambda meta: (n_elements,)
         cross_entropy_loss_kernel[grid](
-            logits, targets, loss,
-            n_classes, n_elements,
-            BLOCK_SIZE=1024
+            logits, targets, loss, lse,
+            logits.stride(0), n_classes,
+            BLOCK_SIZE=triton.next_power_of_2(n_classes)
         )
-        
-        ctx.save_for_backward(logits, targets)
+
+        # the per-row logsumexp is all the backward needs besides the logits themselves
+        ctx.save_for_backward(logits, targets, lse)
         return loss.mean()
 
     @staticmethod
     def backward(ctx, grad_output):
-        logits, targets = ctx.saved_tensors
+        logits, targets, lse = ctx.saved_tensors
         batch_size, n_classes = logits.shape
 
-        logits_exp = torch.exp(logits - logits.max(dim=-1, keepdim=True).values)
-        softmax_output = logits_exp / logits_exp.sum(dim=-1, keepdim=True)
+        grad_input = torch.exp(logits.float() - lse.unsqueeze(1))
+        grad_input[torch.arange(batch_size, device=logits.device), targets] -= 1.0
+        grad_input *= grad_output / batch_size
 
-        grad_input = softmax_output.clone()
-        grad_input.scatter_add_(1, targets.unsqueeze(1), -torch.ones_like(grad_input))
-        grad_input *= grad_output.view(-1, 1) / batch_size
+        return grad_input.to(logits.dtype), None
 
-        return grad_input, None
 
+def persistent_grid(M, device, programs_per_sm=4):
+    # enough resident programs to fill every SM, each strides over the remaining row tiles
+    num_sms = torch.cuda.get_device_properties(device).multi_processor_count
+    return lambda meta: (min(num_sms * programs_per_sm, triton.cdiv(M, meta['ROWS_PER_TILE'])),)
 
 class TritonLayerNorm(nn.Module):
     def __init__(self, normalized_shape, eps=1e-5):
@@ -223,90 +540,344 @@ class TritonLayerNorm(nn.Module):
 
     def forward(self, x):
         assert x.shape[-len(self.normalized_shape):] == self.normalized_shape, "Input shape does not match normalized_shape."
-        y = torch.empty_like(x)
-        x_ = x.reshape(-1, self.normalized_shape[-1])
-        y_ = y.reshape(-1, self.normalized_shape[-1])
-        M, N = x_.shape
-        grid = lambda meta: (triton.cdiv(M, meta['BLOCK_SIZE']),)
-        layer_norm_kernel[grid](
-            x_, self.weight, self.bias, y_,
-            N, eps=self.eps,
-            BLOCK_SIZE=128
-        )
+        # the fused kernel without a residual, which also gives it a backward
+        _, y = triton_fused_add_layer_norm(x, None, self.weight, self.bias, self.eps)
         return y
 
-class TritonGELU(nn.Module):
-    def forward(self, x):
+def autocast_dtype(x):
+    # the device-type arguments need torch >= 2.4, older releases only have the CUDA-specific calls
+    if hasattr(torch, 'get_autocast_dtype'):
+        enabled, dtype = torch.is_autocast_enabled('cuda'), torch.get_autocast_dtype('cuda')
+    else:
+        enabled, dtype = torch.is_autocast_enabled(), torch.get_autocast_gpu_dtype()
+    return dtype if enabled else x.dtype
+
+def triton_fused_add_layer_norm(x, residual, weight, bias, eps):
+    return TritonFusedAddLayerNorm.apply(x, residual, weight, bias, eps)
+
+class TritonFusedAddLayerNorm(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, residual, weight, bias, eps):
+        N = x.shape[-1]
+        x_ = x.reshape(-1, N)
+        M = x_.shape[0]
+        has_residual = residual is not None
+        res_ = residual.reshape(-1, N) if has_residual else x_
+        x_out = torch.empty_like(x_) if has_residual else x_
+        # y only feeds linears, so under autocast it is written directly in the autocast dtype
+        y = torch.empty_like(x_, dtype=autocast_dtype(x))
+
+        grid = persistent_grid(M, x.device)
+        fused_add_layer_norm_kernel[grid](
+            x_, res_, weight, bias, y, x_out,
+            M, N, eps=eps,
+            HAS_RESIDUAL=has_residual, BLOCK_SIZE=triton.next_power_of_2(N)
+        )
+
+        ctx.save_for_backward(x_out, weight)
+        ctx.eps = eps
+        ctx.has_residual = has_residual
+        ctx.residual_dtype = residual.dtype if has_residual else None
+        return x_out.view_as(x), y.view_as(x)
+
+    @staticmethod
+    def backward(ctx, grad_x_out, grad_y):
+        x, weight = ctx.saved_tensors
+        N = x.shape[-1]
+        x = x.float()
+        grad_y = grad_y.reshape(-1, N).float()
+
+        mean = x.mean(dim=-1, keepdim=True)
+        x_centered = x - mean
+        rstd = torch.rsqrt((x_centered * x_centered).mean(dim=-1, keepdim=True) + ctx.eps)
+        x_hat = x_centered * rstd
+
+        grad_weight = (grad_y * x_hat).sum(dim=0)
+        grad_bias = grad_y.sum(dim=0)
+
+        grad_x_hat = grad_y * weight
+        grad_x = rstd * (
+            grad_x_hat
+            - grad_x_hat.mean(dim=-1, keepdim=True)
+            - x_hat * (grad_x_hat * x_hat).mean(dim=-1, keepdim=True)
+        )
+        grad_x = (grad_x.view_as(grad_x_out) + grad_x_out).to(grad_x_out.dtype)
+        grad_residual = grad_x.to(ctx.residual_dtype) if ctx.has_residual else None
+
+        return grad_x, grad_residual, grad_weight.to(weight.dtype), grad_bias.to(weight.dtype), None
+
+class FusedAddLayerNorm(TritonLayerNorm):
+    def forward(self, x, residual=None):
+        # returns (x + residual, layer_norm(x + residual)), residual=None normalizes x as is
+        return triton_fused_add_layer_norm(x, residual, self.weight, self.bias, self.eps)
+
+def triton_bias_gelu(x, bias):
+    return TritonBiasGELU.apply(x, bias)
+
+class TritonBiasGELU(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, bias):
         n_elements = x.numel()
         y = torch.empty_like(x)
         grid = lambda meta: (triton.cdiv(n_elements, meta['BLOCK_SIZE']),)
-        gelu_kernel[grid](
-            x, y, n_elements,
-            BLOCK_SIZE=1024
+        bias_gelu_kernel[grid](
+            x, bias, y, n_elements, bias.numel()
         )
+        ctx.save_for_backward(x, bias)
         return y
 
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, bias = ctx.saved_tensors
+        z = x.float() + bias.float()
+
+        cdf = 0.5 * (1.0 + torch.erf(z * 0.7071067811865475))
+        pdf = torch.exp(-0.5 * z * z) * 0.3989422804014327
+        grad_x = grad_output.float() * (cdf + z * pdf)
+        grad_bias = grad_x.reshape(-1, bias.numel()).sum(dim=0)
+
+        return grad_x.to(x.dtype), grad_bias.to(bias.dtype)
+
+def triton_fused_qkv_proj(x, weight, n_heads):
+    return TritonFusedQKVProj.apply(x, weight, n_heads)
+
+class TritonFusedQKVProj(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, weight, n_heads):
+        B, T, C = x.shape
+        N = weight.shape[0]
+        head_dim = N // (3 * n_heads)
+
+        # a custom kernel is not autocast, cast both operands the way F.linear would be
+        dtype = autocast_dtype(x)
+        x_ = x.reshape(B * T, C).to(dtype)
+        w = weight.to(dtype)
+        out = torch.empty(3, B, n_heads, T, head_dim, device=x.device, dtype=dtype)
+
+        M = B * T
+        grid = lambda meta: (triton.cdiv(M, meta['BLOCK_M']), triton.cdiv(N, meta['BLOCK_N']))
+        fused_qkv_proj_kernel[grid](
+            x_, w, out,
+            M, N, C, T, n_heads, head_dim,
+            x_.stride(0), x_.stride(1),
+            w.stride(0), w.stride(1),
+            out.stride(0), out.stride(1), out.stride(2), out.stride(3), out.stride(4)
+        )
+
+        ctx.save_for_backward(x_, w)
+        ctx.x_shape = x.shape
+        ctx.x_dtype = x.dtype
+        ctx.weight_dtype = weight.dtype
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, w = ctx.saved_tensors
+        _, B, H, T, D = grad_output.shape
+
+        # back to the (B*T, 3*C) layout of a plain linear
+        grad_output = grad_output.permute(1, 3, 0, 2, 4).reshape(B * T, 3 * H * D).to(w.dtype)
+        grad_x = (grad_output @ w).view(ctx.x_shape).to(ctx.x_dtype)
+        grad_weight = (grad_output.t() @ x).to(ctx.weight_dtype)
+
+        return grad_x, grad_weight, None
+
+def triton_flash_attention(q, k, v, scale, dropout_p=0.0):
+    return TritonFlashAttention.apply(q, k, v, scale, dropout_p)
+
+class TritonFlashAttention(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, q, k, v, scale, dropout_p):
+        B, H, T, D = q.shape
+        # written in (B, T, H, D) memory order so merging the heads afterwards is a free view
+        out = q.new_empty(B, T, H, D).transpose(1, 2)
+        lse = torch.empty(B, H, T, device=q.device, dtype=torch.float32)
+        # the seed stays on the device and is loaded in-kernel: no .item() sync or graph break,
+        # and torch.manual_seed still makes runs reproducible. Without dropout it is never read
+        seed = torch.randint(0, 2 ** 31 - 1, (1,), device=q.device) if dropout_p > 0 else lse
+
+        # tl.dot needs tiles of at least 16, head_dim is padded up and masked in-kernel
+        grid = lambda meta: (triton.cdiv(T, meta['BLOCK_M']), B * H)
+        flash_attn_fwd_kernel[grid](
+            q, k, v, out, lse, scale, dropout_p, seed,
+            q.stride(0), q.stride(1), q.stride(2), q.stride(3),
+            k.stride(0), k.stride(1), k.stride(2), k.stride(3),
+            v.stride(0), v.stride(1), v.stride(2), v.stride(3),
+            out.stride(0), out.stride(1), out.stride(2), out.stride(3),
+            H, T, D,
+            BLOCK_DMODEL=max(16, triton.next_power_of_2(D)),
+            IS_CAUSAL=True, DROPOUT=dropout_p > 0
+        )
+
+        ctx.save_for_backward(q, k, v, out, lse, seed)
+        ctx.scale = scale
+        ctx.dropout_p = dropout_p
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        q, k, v, out, lse, seed = ctx.saved_tensors
+        B, H, T, D = q.shape
+        # one contiguous layout for every operand, dO usually arrives as a strided view of the merged heads
+        q, k, v, grad_output = q.contiguous(), k.contiguous(), v.contiguous(), grad_output.contiguous()
+        grad_q, grad_k, grad_v = torch.empty_like(q), torch.empty_like(k), torch.empty_like(v)
+
+        # rowsum(dP * P) == rowsum(dO * O), which holds with dropout too
+        delta = (grad_output.float() * out.float()).sum(dim=-1)
+
+        # P and the dropout mask are rebuilt tile by tile in SRAM, nothing (T, T) is written to HBM
+        block_dmodel = max(16, triton.next_power_of_2(D))
+        grid = lambda meta: (triton.cdiv(T, meta['BLOCK_N']), B * H)
+        flash_attn_bwd_dkdv_kernel[grid](
+            q, k, v, grad_output, lse, delta, grad_k, grad_v,
+            ctx.scale, ctx.dropout_p, seed,
+            q.stride(0), q.stride(1), q.stride(2), q.stride(3),
+            H, T, D,
+            BLOCK_DMODEL=block_dmodel,
+            IS_CAUSAL=True, DROPOUT=ctx.dropout_p > 0
+        )
+        grid = lambda meta: (triton.cdiv(T, meta['BLOCK_M']), B * H)
+        flash_attn_bwd_dq_kernel[grid](
+            q, k, v, grad_output, lse, delta, grad_q,
+            ctx.scale, ctx.dropout_p, seed,
+            q.stride(0), q.stride(1), q.stride(2), q.stride(3),
+            H, T, D,
+            BLOCK_DMODEL=block_dmodel,
+            IS_CAUSAL=True, DROPOUT=ctx.dropout_p > 0
+        )
+
+        return grad_q, grad_k, grad_v, None, None
+
+def triton_flash_attention_decode(q, kv_cache, scale):
+    B, H, _, D = q.shape
+    k, v = kv_cache.k, kv_cache.v
+    out = torch.empty_like(q)
+
+    # unquantized caches pass K in place of the scales, KV_INT8=False never reads them
+    quantized = kv_cache.quantize
+    k_scale = kv_cache.k_scale if quantized else k
+    v_scale = kv_cache.v_scale if quantized else v
+
+    grid = lambda meta: (B * H,)
+    flash_attn_decode_kernel[grid](
+        q, k, v, k_scale, v_scale, out, scale,
+        q.stride(0), q.stride(1), q.stride(3),
+        k.stride(0), k.stride(1), k.stride(2), k.stride(3),
+        v.stride(0), v.stride(1), v.stride(2), v.stride(3),
+        k_scale.stride(0), k_scale.stride(1),
+        out.stride(0), out.stride(1), out.stride(3),
+        H, kv_cache.length, D,
+        BLOCK_DMODEL=max(16, triton.next_power_of_2(D)),
+        KV_INT8=quantized
+    )
+    return out
+
 # -----------------------------
 # Model
 # -----------------------------
 
+def quantize_int8(x):
+    # symmetric absmax quantization with one fp16 scale per head_dim vector (one per token and head)
+    # the floor is applied after the cast, a smaller one would round to 0 in fp16 and divide by zero
+    scale = (x.float().abs().amax(dim=-1) / 127.0).half().clamp_min(torch.finfo(torch.float16).tiny)
+    x_q = torch.round(x.float() / scale.float().unsqueeze(-1)).clamp(-127, 127).to(torch.int8)
+    return x_q, scale
+
+class KVCache:
+    def __init__(self, max_seq_length, quantize=False):
+        self.max_seq_length = max_seq_length
+        self.quantize = quantize
+        self.length = 0
+        self.k = self.v = None
+        self.k_scale = self.v_scale = None
+
+    def append(self, k, v):
+        B, H, T, D = k.shape
+        if self.k is None:
+            # buffers are sized on first use, (B, H, max_seq_length, D) like the attention inputs
+            dtype = torch.int8 if self.quantize else k.dtype
+            self.k = torch.empty(B, H, self.max_seq_length, D, device=k.device, dtype=dtype)
+            self.v = torch.empty_like(self.k)
+            if self.quantize:
+                self.k_scale = torch.empty(B, H, self.max_seq_length, device=k.device, dtype=torch.float16)
+                self.v_scale = torch.empty_like(self.k_scale)
+
+        start, end = self.length, self.length + T
+        assert end <= self.max_seq_length, f"KV cache is full ({self.max_seq_length} positions)"
+        if self.quantize:
+            self.k[:, :, start:end], self.k_scale[:, :, start:end] = quantize_int8(k)
+            self.v[:, :, start:end], self.v_scale[:, :, start:end] = quantize_int8(v)
+        else:
+            self.k[:, :, start:end] = k
+            self.v[:, :, start:end] = v
+        self.length = end
+
 class MultiHeadAttention(nn.Module):
-    def __init__(self, dim, num_heads, seq_length, dropout=0.1):
+    def __init__(self, dim, num_heads, seq_length, dropout=0.1, flash=True):
         super().__init__()
         self.num_heads = num_heads
         self.head_dim = dim // num_heads
         self.scale = self.head_dim ** -0.5
         self.seq_length = seq_length
+        self.flash = flash
 
         self.qkv = nn.Linear(dim, dim * 3, bias=False)
         self.proj = nn.Linear(dim, dim, bias=False)
         self.dropout = nn.Dropout(dropout)
 
-        self.softmax = TritonSoftmax()
-        self.register_buffer("mask", torch.tril(torch.ones(seq_length, seq_length)).bool())
-
-    def forward(self, x):
+    def forward(self, x, kv_cache=None):
         B, T, C = x.shape
-        qkv = self.qkv(x).reshape(B, T, 3, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4)
-        q, k, v = qkv[0], qkv[1], qkv[2]
-
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.masked_fill(~self.mask[:T, :T], float('-inf'))
-        attn = self.softmax(attn)
-        attn = self.dropout(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B, T, C)
+        # the projection GEMM stores (3, B, H, T, D) directly, so q, k and v come out contiguous
+        q, k, v = triton_fused_qkv_proj(x, self.qkv.weight, self.num_heads).unbind(dim=0)
+
+        if kv_cache is not None:
+            # a prompt prefills an empty cache, after that tokens come one at a time
+            assert T == 1 or kv_cache.length == 0, "multi-token steps need an empty KV cache"
+            kv_cache.append(k, v)
+
+        dropout_p = self.dropout.p if self.training else 0.0
+        if kv_cache is not None and T == 1:
+            x = triton_flash_attention_decode(q, kv_cache, self.scale)
+        elif self.flash:
+            # fused causal attention, the (T, T) scores and their dropout never leave SRAM
+            x = triton_flash_attention(q, k, v, self.scale, dropout_p)
+        else:
+            # PyTorch's fused attention (its own flash / mem-efficient backends) as fallback and reference
+            x = F.scaled_dot_product_attention(q, k, v, is_causal=True, dropout_p=dropout_p, scale=self.scale)
+
+        x = x.transpose(1, 2).reshape(B, T, C)
         x = self.proj(x)
         return x
 
 class FeedForward(nn.Module):
     def __init__(self, dim, hidden_dim, dropout=0.1):
         super().__init__()
-        self.net = nn.Sequential(
-            nn.Linear(dim, hidden_dim, bias=False),
-            TritonGELU(),
-            nn.Linear(hidden_dim, dim, bias=False),
-            nn.Dropout(dropout)
-        )
+        self.fc1 = nn.Linear(dim, hidden_dim)
+        self.fc2 = nn.Linear(hidden_dim, dim)
+        self.dropout = nn.Dropout(dropout)
 
     def forward(self, x):
-        return self.net(x)
+        # fc1's bias is added inside the GELU kernel rather than by the GEMM
+        h = triton_bias_gelu(F.linear(x, self.fc1.weight), self.fc1.bias)
+        return self.dropout(self.fc2(h))
 
 class TransformerBlock(nn.Module):
-    def __init__(self, dim, num_heads, seq_length, dropout=0.1):
+    def __init__(self, dim, num_heads, seq_length, dropout=0.1, flash=True):
         super().__init__()
-        self.attn = MultiHeadAttention(dim, num_heads, seq_length, dropout)
+        self.attn = MultiHeadAttention(dim, num_heads, seq_length, dropout, flash)
         self.ff = FeedForward(dim, 4 * dim, dropout)
-        self.ln1 = TritonLayerNorm(dim)
-        self.ln2 = TritonLayerNorm(dim)
+        self.ln1 = FusedAddLayerNorm(dim)
+        self.ln2 = FusedAddLayerNorm(dim)
 
-    def forward(self, x):
-        x = x + self.attn(self.ln1(x))
-        x = x + self.ff(self.ln2(x))
-        return x
+    def forward(self, x, residual=None, kv_cache=None):
+        # residual adds are deferred into the following LayerNorm, the ff output
+        # is handed back un-added so the next block (or ln_f) can fuse it too
+        x, h = self.ln1(x, residual)
+        x, h = self.ln2(x, self.attn(h, kv_cache))
+        return x, self.ff(h)
 
 class NanoGPT(nn.Module):
-    def __init__(self, vocab_size, dim, num_heads, num_layers, seq_length, dropout=0.1):
+    def __init__(self, vocab_size, dim, num_heads, num_layers, seq_length, dropout=0.1, flash=True):
         super().__init__()
         self.dim = dim
         self.num_heads = num_heads
@@ -316,10 +887,10 @@ class NanoGPT(nn.Module):
         self.token_embedding = nn.Embedding(vocab_size, dim)
         self.position_embedding = nn.Embedding(seq_length, dim)
         self.blocks = nn.ModuleList([
-            TransformerBlock(dim, num_heads, seq_length, dropout)
+            TransformerBlock(dim, num_heads, seq_length, dropout, flash)
             for _ in range(num_layers)
         ])
-        self.ln_f = TritonLayerNorm(dim)
+        self.ln_f = FusedAddLayerNorm(dim)
         self.head = nn.Linear(dim, vocab_size, bias=False)
 
         self.apply(self._init_weights)
@@ -327,42 +898,75 @@ class NanoGPT(nn.Module):
     def _init_weights(self, module):
         if isinstance(module, nn.Linear):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
+            if module.bias is not None:
+                torch.nn.init.zeros_(module.bias)
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
-    def forward(self, idx):
+    def forward(self, idx, kv_caches=None):
         B, T = idx.shape
-        assert T <= self.seq_length, f"Input sequence length {T} exceeds model's maximum sequence length {self.seq_length}"
+        # with KV caches idx only holds the tokens that are not cached yet
+        start = kv_caches[0].length if kv_caches is not None else 0
+        assert start + T <= self.seq_length, f"Input sequence length {start + T} exceeds model's maximum sequence length {self.seq_length}"
 
         tok_emb = self.token_embedding(idx)
-        pos_emb = self.position_embedding(torch.arange(T, device=idx.device))
+        # positions are always start..start+T-1, so the lookup is just a view of those rows
+        pos_emb = self.position_embedding.weight[start:start + T]
         x = tok_emb + pos_emb
 
-        for block in self.blocks:
-            x = block(x)
+        if kv_caches is None:
+            kv_caches = [None] * self.num_layers
 
-        x = self.ln_f(x)
+        residual = None
+        for block, kv_cache in zip(self.blocks, kv_caches):
+            x, residual = block(x, residual, kv_cache)
+
+        _, x = self.ln_f(x, residual)
         logits = self.head(x)
 
         return logits
 
+    def init_kv_cache(self, quantize=False):
+        return [KVCache(self.seq_length, quantize=quantize) for _ in range(self.num_layers)]
+
+    def step(self, idx, kv_caches):
+        # feed the prompt first, then one sampled token per call; only new positions are computed
+        logits = self(idx, kv_caches)
+        return logits[:, -1, :], kv_caches
+
     def compute_loss(self, logits, targets):
-        return triton_cross_entropy_loss(logits.view(-1, logits.size(-1)), targets.view(-1))
+        return triton_cross_entropy_loss(logits.view(-1, logits.size(-1)), targets.reshape(-1))
 
 #----------------------------
 # Training
 #----------------------------
 
-def train(model, train_data, val_data, batch_size, seq_length, learning_rate, num_epochs):
+def train(model, train_data, val_data, batch_size, seq_length, learning_rate, num_epochs, compile_model=True):
+    # the compiled wrapper is only used for the forward pass, checkpoints and the optimizer
+    # keep working on the plain module so state_dict keys are unchanged
+    forward_model = torch.compile(model) if compile_model else model
+
     optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate, weight_decay=0.1)
     scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=num_epochs)
 
+    # bf16 only where it has tensor cores (sm80+, Ampere on), fp16 otherwise (e.g. T4, sm75).
+    # is_bf16_supported() is also True on sm75 through emulation, so ask for the capability instead;
+    # only fp16 needs loss scaling
+    amp_dtype = torch.bfloat16 if torch.cuda.get_device_capability()[0] >= 8 else torch.float16
+    # torch.amp.GradScaler takes a device type from torch 2.3 on
+    if hasattr(torch.amp, 'GradScaler'):
+        scaler = torch.amp.GradScaler('cuda', enabled=amp_dtype == torch.float16)
+    else:
+        scaler = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)
+
+    window_offsets = torch.arange(seq_length + 1, device=train_data.device)
+
     def get_batch(split):
         data = train_data if split == 'train' else val_data
-        ix = torch.randint(len(data) - seq_length, (batch_size,))
-        x = torch.stack([data[i:i+seq_length] for i in ix])
-        y = torch.stack([data[i+1:i+seq_length+1] for i in ix])
-        return x.to(model.token_embedding.weight.device), y.to(model.token_embedding.weight.device)
+        # one gather of (batch_size, seq_length + 1) windows on the data's device, x/y are shifted views
+        ix = torch.randint(len(data) - seq_length, (batch_size,), device=data.device)
+        xy = data[ix[:, None] + window_offsets]
+        return xy[:, :-1], xy[:, 1:]
 
     def estimate_mfu(model, dt):
         """ estimate model flops utilization (MFU) in units of A100 bfloat16 peak FLOPS """
@@ -394,11 +998,13 @@ def train(model, train_data, val_data, batch_size, seq_length, learning_rate, nu
             t_data = time.time()
 
             # Forward pass
-            logits = model(xb)
+            with torch.autocast(device_type='cuda', dtype=amp_dtype):
+                logits = forward_model(xb)
             t_forward = time.time()
 
             # Loss computation
-            loss = model.compute_loss(logits, yb)
+            with torch.autocast(device_type='cuda', dtype=amp_dtype):
+                loss = model.compute_loss(logits, yb)
             t_loss = time.time()
 
             if torch.isnan(loss).any() or torch.isinf(loss).any():
@@ -409,12 +1015,14 @@ def train(model, train_data, val_data, batch_size, seq_length, learning_rate, nu
 
             # Backward pass
             optimizer.zero_grad()
-            loss.backward()
+            scaler.scale(loss).backward()
             t_backward = time.time()
 
             # Optimizer step
+            scaler.unscale_(optimizer)
             torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
-            optimizer.step()
+            scaler.step(optimizer)
+            scaler.update()
             torch.cuda.synchronize()
             t_optim = time.time()
 
@@ -443,8 +1051,9 @@ def train(model, train_data, val_data, batch_size, seq_length, learning_rate, nu
         with torch.no_grad():
             for _ in range(50):  # 50 val batches
                 xb, yb = get_batch('val')
-                logits = model(xb)
-                val_loss += model.compute_loss(logits, yb).item()
+                with torch.autocast(device_type='cuda', dtype=amp_dtype):
+                    logits = forward_model(xb)
+                    val_loss += model.compute_loss(logits, yb).item()
         val_loss /= 50
         val_losses.append(val_loss)
         print(f"Epoch {epoch+1}/{num_epochs}, Validation Loss: {val_loss:.4f}")
@@ -462,6 +1071,32 @@ if __name__ == "__main__":
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"Using device: {device}")
 
+    dataset(url, filepath)
+    with open(filepath, 'r') as f:
+        text = f.read()
+
+    chars = sorted(list(set(text)))
+    print(f"Vocabulary size: {len(chars)}")
+
+    # byte-level lookup tables so encode/decode are single tensor ops instead of per-char Python
+    assert all(ord(c) < 256 for c in chars), "lookup tables assume a single-byte (latin-1) vocabulary"
+    stoi = torch.full((256,), -1, dtype=torch.long)
+    stoi[torch.tensor([ord(c) for c in chars])] = torch.arange(len(chars))
+    itos = torch.tensor([ord(c) for c in chars], dtype=torch.uint8)
+
+    data = encode(text)
+
+    n = int(0.9 * len(data))
+    train_data = data[:n].cuda()
+    test_data = data[n:].cuda()
+
+    print(f"Training data size: {train_data.numel()} characters")
+    print(f"Testing data size: {test_data.numel()} characters")
+
+    # fp32 matmuls outside autocast (e.g. generation) may use TF32 tensor cores,
+    # this also covers torch.backends.cuda.matmul.allow_tf32
+    torch.set_float32_matmul_precision('high')
+
     # Hyperparameters
     vocab_size = 65
     dim = 384
@@ -472,6 +1107,7 @@ if __name__ == "__main__":
     batch_size = 64
     learning_rate = 3e-4
     num_epochs = 500
+    kv_cache_int8 = False
 
     model = NanoGPT(
         vocab_size=vocab_size,
@@ -497,7 +1133,8 @@ if __name__ == "__main__":
         batch_size=batch_size,
         seq_length=seq_length,
         learning_rate=learning_rate,
-        num_epochs=num_epochs
+        num_epochs=num_epochs,
+        compile_model=True
     )
 
     # Load checkpoint
@@ -507,17 +1144,12 @@ if __name__ == "__main__":
     model.eval()
     start_text = "Once upon"
     input_ids = encode(start_text).unsqueeze(0).to(device)
+    kv_cache = model.init_kv_cache(quantize=kv_cache_int8)
+    next_token = input_ids
     with torch.no_grad():
         for _ in range(240):
-            logits = model(input_ids)
-            next_token_logits = logits[:, -1, :]
-            next_token_logits = torch.clamp(next_token_logits, -100, 100)
-            probs = F.softmax(next_token_logits, dim=-1) + 1e-8
-            probs = probs / probs.sum()
-            if torch.isnan(probs).any() or torch.isinf(probs).any():
-                probs = torch.ones_like(probs) / probs.shape[-1]
-            
-            next_token = torch.multinomial(probs, num_samples=1)
+            next_token_logits, kv_cache = model.step(next_token, kv_cache)
+            next_token = triton_sample(next_token_logits)
             input_ids = torch.cat([input_ids, next_token], dim=1)
 
     generated_text = decode(input_ids[0].cpu())